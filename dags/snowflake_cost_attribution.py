@@ -6,33 +6,216 @@ These credit costs are sent to the Astronomer API for cost tracking.
 """
 
 from airflow.decorators import dag, task
-from airflow.providers.common.sql.operators.sql import SQLExecuteQueryOperator
+from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
 
 import os
 import datetime
+import decimal
+import json
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pprint
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the (slower) stdlib encoder
+    orjson = None
+
+ASTRO_API_URL = "https://api.astronomer.io"
+
+# Metric lists are posted in pages of this many items, with at most
+# MAX_CONCURRENT_POSTS requests in flight (matching the connection pool size).
+METRICS_CHUNK_SIZE = 1000
+MAX_CONCURRENT_POSTS = 16
+
+SNOWFLAKE_CONN_ID = "snowflake"
+
+# Session parameters for the account_usage queries, applied underneath any the Snowflake
+# connection already sets. Task retries re-run byte-identical SQL (sorted query IDs), so
+# with result reuse on they can be answered from the result cache, as long as the
+# account_usage views haven't changed in the meantime. The query tag makes this DAG's own
+# Snowflake usage easy to find in query_history.
+SNOWFLAKE_SESSION_PARAMETERS = {
+    "USE_CACHED_RESULT": True,
+    "QUERY_TAG": "astro-observe-cost",
+}
+
+# Snowflake caps the number of expressions in an IN list, so query IDs are split into
+# batches of at most this size, each queried by its own mapped task.
+SNOWFLAKE_IN_LIST_LIMIT = 16000
+
+# Number of result rows fetched from Snowflake, transformed and posted at a time.
+SNOWFLAKE_FETCH_SIZE = 10_000
+
+# Timeout in seconds for the account_usage queries. Tasks that query Snowflake have no
+# execution_timeout, so a slow query isn't cut short by a budget meant for posting.
+SNOWFLAKE_QUERY_TIMEOUT = 30 * 60
+
+# A single query per batch serves both the cost and the rows processed metrics.
+# query_history is the superset, so queries without a query_attribution_history row yet
+# come back with is_attributed false and no credits.
+QUERY_ATTRIBUTION_SQL = """
+    select
+        qh.query_id,
+        qh.end_time,
+        qah.query_id is not null as is_attributed,
+        qah.credits_attributed_compute,
+        qh.rows_produced,
+        qh.rows_inserted,
+        qh.rows_updated,
+        qh.rows_deleted,
+        qh.rows_unloaded,
+        qh.total_elapsed_time,
+        qh.bytes_scanned
+    from snowflake.account_usage.query_history qh
+    left join snowflake.account_usage.query_attribution_history qah
+        on qah.query_id = qh.query_id
+    where qh.query_id in (%s)
+"""
+
+# (connect, read) timeouts in seconds, so a stuck endpoint fails fast instead of
+# holding the worker slot until the task's execution_timeout.
+REQUEST_TIMEOUT = (5, 30)
+
+# The credits go out as one unpaged request whose body grows with the query window, so
+# the API gets longer to read and process it before the post is treated as failed.
+CREDITS_REQUEST_TIMEOUT = (5, 300)
+
+# Shared session so repeated calls to the Astronomer API reuse pooled keep-alive
+# connections instead of paying for a new TCP + TLS handshake on every request.
+_SESSION = requests.Session()
+_SESSION.headers.update({"X-Astro-Client-Identifier": "astro-observe-sdk"})
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=MAX_CONCURRENT_POSTS,
+        # urllib3 only retries idempotent methods by default, so this covers the
+        # external-queries GET. Metric POSTs are deliberately not retried here, since
+        # a request the API accepted but answered with an error would be counted twice.
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Hand the final response back so raise_for_status() reports its status
+            # and body, instead of urllib3 raising a bare RetryError.
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+def _json_default(obj):
+    # Snowflake returns NUMBER columns with a scale as Decimal
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# helper function to serialize a request body to JSON bytes
+def _dumps(body: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(body, default=_json_default)
+    return json.dumps(body, default=_json_default).encode("utf-8")
 
 
 # helper function to post metrics to the Astronomer API
-def post_metrics(token: str, category: str, type: str, data: list) -> None:
-    print(f"::group::Posting {len(data)} {type} items:")
-    pprint(data, indent=2)
-    print("::endgroup::")
+def post_metrics(
+    token: str,
+    category: str,
+    type: str,
+    data: list,
+    timeout: tuple[float, float] = REQUEST_TIMEOUT,
+) -> None:
+    print(f"Posting {len(data)} {type} items.")
+    # Dumping every payload is expensive for large batches, so only sample it on request.
+    if os.getenv("DEBUG_METRICS") == "1":
+        print(f"::group::First {min(len(data), 10)} {type} items:")
+        pprint(data[:10], indent=2)
+        if len(data) > 10:
+            print(f"... and {len(data) - 10} more")
+        print("::endgroup::")
 
     org_id = os.getenv("ASTRO_ORGANIZATION_ID")
 
-    resp = requests.post(
-        f"https://api.astronomer.io/private/v1alpha1/organizations/{org_id}/observability/metrics",
-        json={"category": category, "type": f"{type}", "metrics": data},
+    resp = _SESSION.post(
+        f"{ASTRO_API_URL}/private/v1alpha1/organizations/{org_id}/observability/metrics",
+        data=_dumps({"category": category, "type": f"{type}", "metrics": data}),
         headers={
             "Authorization": f"Bearer {token}",
-            "X-Astro-Client-Identifier": "astro-observe-sdk",
+            "Content-Type": "application/json",
         },
+        timeout=timeout,
     )
 
-    if resp.status_code != 200:
-        raise Exception(f"Failed to post data: {resp.text}")
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        raise Exception(
+            f"Failed to post {type}: {resp.status_code}:{resp.reason} {resp.text}"
+        ) from e
+
+
+# helper function to post several metric groups to the Astronomer API in one go
+def post_metrics_batch(token: str, groups: list[dict]) -> None:
+    """
+    Posts a list of ``{"category", "type", "metrics"}`` groups. The metrics endpoint accepts
+    a single type per request, so each group is split into pages of METRICS_CHUNK_SIZE items
+    and the pages are sent concurrently over the shared session.
+
+    Posting is not atomic: if any page fails the call raises, and a retry re-sends the
+    pages that were already accepted. Only use it for metrics where that is acceptable.
+    """
+    jobs = [
+        (group["category"], group["type"], group["metrics"][i : i + METRICS_CHUNK_SIZE])
+        for group in groups
+        for i in range(0, len(group["metrics"]), METRICS_CHUNK_SIZE)
+    ]
+    if not jobs:
+        return
+
+    errors = []
+    with ThreadPoolExecutor(
+        max_workers=min(len(jobs), MAX_CONCURRENT_POSTS)
+    ) as executor:
+        futures = [
+            executor.submit(post_metrics, token, category, type, data)
+            for category, type, data in jobs
+        ]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
+        raise Exception(
+            f"Failed to post {len(errors)} of {len(jobs)} metric requests: "
+            + "; ".join(str(e) for e in errors)
+        ) from errors[0]
+
+
+# helper function to turn a datetime into rfc3339 in UTC. Naive values are taken to
+# already be UTC. Uses isoformat rather than strftime, which parses a format string.
+def _rfc3339(value: datetime.datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="microseconds") + "Z"
+
+
+# helper function to pick the fields posted alongside every metric of a query
+def _metric_base(query_meta: dict) -> dict:
+    return {
+        "assetId": query_meta["assetId"],
+        "deploymentId": query_meta["deploymentId"],
+        "workspaceId": query_meta.get("workspaceId"),
+        "runId": query_meta["runId"],
+        "dagId": query_meta["dagId"],
+        "taskId": query_meta["taskId"],
+        "namespace": query_meta["namespace"],
+    }
 
 
 @task
@@ -61,18 +244,16 @@ def get_query_ids(data_interval_start, data_interval_end, var):
         raise ValueError("Missing required Airflow variable AUTH_TOKEN.")
 
     get_queries_url = (
-        f"https://api.astronomer.io/private/v1alpha1/organizations/{org_id}/observability/"
+        f"{ASTRO_API_URL}/private/v1alpha1/organizations/{org_id}/observability/"
         f"external-queries?earliestTime={start}&latestTime={end}"
     )
 
     print(f"Getting queries from {get_queries_url}")
 
-    resp = requests.get(
+    resp = _SESSION.get(
         get_queries_url,
-        headers={
-            "Authorization": f"Bearer {token}",
-            "X-Astro-Client-Identifier": "astro-observe-sdk",
-        },
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=REQUEST_TIMEOUT,
     )
 
     try:
@@ -85,66 +266,64 @@ def get_query_ids(data_interval_start, data_interval_end, var):
     queries = resp.json().get("externalQueries")
     print(f"Collected {len(queries)} queries.")
 
-    # Store mapping for later when we need to post cost attribution
-    query_run_mapping = {query["queryId"]: query for query in queries}
+    # Store mapping for later when we need to post cost attribution. Only the fields
+    # posted with each metric are kept, to keep the XCom small.
+    query_run_mapping = {query["queryId"]: _metric_base(query) for query in queries}
 
     return {
-        "query_ids": list(query_run_mapping.keys()),
+        # Sorted so the generated SQL is identical across retries
+        "query_ids": sorted(query_run_mapping),
         "query_id_map": query_run_mapping,
+        "query_count": len(query_run_mapping),
     }
 
 
 @task.short_circuit
-def check_for_query_ids(this: list[str]) -> bool:
+def check_for_query_ids(this: int) -> bool:
     """Short-circuits the pipeline if no query IDs were retrieved from get_query_ids task."""
-    if not (res := bool(this)):
+    if not (res := this > 0):
         print("No queries retrieved.")
 
     return res
 
 
-@task(execution_timeout=datetime.timedelta(minutes=10))
-def post_cost_attribution(query_costs, ti, var):
-    if not query_costs:
-        print("No costs to post")
-        return
+@task
+def chunk_query_ids(query_ids: list[str]) -> list[list[str]]:
+    """Splits the query IDs into batches that fit in a single Snowflake IN list."""
+    return [
+        query_ids[i : i + SNOWFLAKE_IN_LIST_LIMIT]
+        for i in range(0, len(query_ids), SNOWFLAKE_IN_LIST_LIMIT)
+    ]
 
-    query_run_mapping = ti.xcom_pull(key="query_id_map", task_ids="get_query_ids")
 
-    costs = []
-    for query_id, end_time, credit in query_costs:
-        query_meta = query_run_mapping.get(query_id)
-        costs.append(
-            {
-                "value": credit,
-                "assetId": query_meta["assetId"],
-                "deploymentId": query_meta["deploymentId"],
-                "workspaceId": query_meta.get("workspaceId"),
-                "runId": query_meta["runId"],
-                "dagId": query_meta["dagId"],
-                "taskId": query_meta["taskId"],
-                "namespace": query_meta["namespace"],
-                # Turn the datetime into rfc3339
-                "timestamp": end_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            }
-        )
+# helper function to split a page of attribution rows into cost rows, for the queries
+# present in query_attribution_history, and rows processed rows
+def _split_attribution_rows(rows: list) -> tuple[list, list]:
+    cost_rows = []
+    processed_rows = []
+    for query_id, end_time, is_attributed, credit, *processed in rows:
+        if is_attributed:
+            cost_rows.append((query_id, end_time, credit))
+        processed_rows.append((query_id, end_time, *processed))
 
-    print(f"::group::Posting {len(costs)} cost items:")
-    pprint(costs, indent=2)
-    print("::endgroup::")
+    return cost_rows, processed_rows
 
-    token = var["value"].AUTH_TOKEN
-    post_metrics(token, "COST", "SNOWFLAKE_CREDITS", costs)
 
+# helper function to turn cost attribution rows into SNOWFLAKE_CREDITS metrics
+def _cost_metrics(rows: list, base_by_query_id: dict) -> list[dict]:
+    costs = []
+    for query_id, end_time, credit in rows:
+        # Copying the prebuilt dict is cheaper than building a new literal per row
+        cost = base_by_query_id[query_id].copy()
+        cost["timestamp"] = _rfc3339(end_time)
+        cost["value"] = credit
+        costs.append(cost)
 
-@task(execution_timeout=datetime.timedelta(minutes=10))
-def post_query_rows_processed(rows_processed, var, ti):
-    if not rows_processed:
-        print("No rows processed to post")
-        return
+    return costs
 
-    query_run_mapping = ti.xcom_pull(key="query_id_map", task_ids="get_query_ids")
 
+# helper function to turn a page of query history rows into rows processed metrics
+def _rows_processed_metrics(rows: list, base_by_query_id: dict) -> list[dict]:
     produced = []
     inserted = []
     updated = []
@@ -154,6 +333,7 @@ def post_query_rows_processed(rows_processed, var, ti):
     scanned = []
     for (
         query_id,
+        end_time,
         rows_produced,
         rows_inserted,
         rows_updated,
@@ -161,48 +341,114 @@ def post_query_rows_processed(rows_processed, var, ti):
         rows_unloaded,
         total_elapsed_time,
         bytes_scanned,
-        end_time,
-    ) in rows_processed:
-        query_meta = query_run_mapping.get(query_id)
-
-        def make_row(value):
-            value = value if value is not None else 0
-            return {
-                "value": value,
-                "assetId": query_meta["assetId"],
-                "deploymentId": query_meta["deploymentId"],
-                "workspaceId": query_meta.get("workspaceId"),
-                "runId": query_meta["runId"],
-                "dagId": query_meta["dagId"],
-                "taskId": query_meta["taskId"],
-                "namespace": query_meta["namespace"],
-                "timestamp": end_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            }
-
-        produced.append(make_row(rows_produced))
-        inserted.append(make_row(rows_inserted))
-        updated.append(make_row(rows_updated))
-        deleted.append(make_row(rows_deleted))
-        unloaded.append(make_row(rows_unloaded))
-        elapsed.append(make_row(total_elapsed_time))
-        scanned.append(make_row(bytes_scanned))
+    ) in rows:
+        base = {**base_by_query_id[query_id], "timestamp": _rfc3339(end_time)}
+
+        produced.append({**base, "value": rows_produced or 0})
+        inserted.append({**base, "value": rows_inserted or 0})
+        updated.append({**base, "value": rows_updated or 0})
+        deleted.append({**base, "value": rows_deleted or 0})
+        unloaded.append({**base, "value": rows_unloaded or 0})
+        elapsed.append({**base, "value": total_elapsed_time or 0})
+        scanned.append({**base, "value": bytes_scanned or 0})
+
+    rows_metrics = {
+        "SNOWFLAKE_ROWS_PRODUCED": produced,
+        "SNOWFLAKE_ROWS_INSERTED": inserted,
+        "SNOWFLAKE_ROWS_UPDATED": updated,
+        "SNOWFLAKE_ROWS_DELETED": deleted,
+        "SNOWFLAKE_ROWS_UNLOADED": unloaded,
+        "SNOWFLAKE_TOTAL_ELAPSED_TIME": elapsed,
+        "SNOWFLAKE_BYTES_SCANNED": scanned,
+    }
+    return [
+        {"category": "CUSTOM", "type": type, "metrics": metrics}
+        for type, metrics in rows_metrics.items()
+    ]
 
+
+# helper function to merge our session parameters with the connection's own. Parameters
+# passed to the hook replace the connection's session_parameters extra rather than
+# adding to it, and settings such as TIMEZONE affect the end_time values we post.
+def _session_parameters(connection_parameters: dict | None) -> dict:
+    return {**SNOWFLAKE_SESSION_PARAMETERS, **(connection_parameters or {})}
+
+
+# helper function to build the hook used for the account_usage query. Each batch of
+# query IDs opens one connection through it and runs the single QUERY_ATTRIBUTION_SQL
+# statement, so the warehouse is touched once per batch.
+def _snowflake_hook() -> SnowflakeHook:
+    extra = SnowflakeHook.get_connection(SNOWFLAKE_CONN_ID).extra_dejson
+    return SnowflakeHook(
+        snowflake_conn_id=SNOWFLAKE_CONN_ID,
+        session_parameters=_session_parameters(extra.get("session_parameters")),
+    )
+
+
+@task(execution_timeout=datetime.timedelta(minutes=10))
+def post_cost_attribution(query_costs, ti, var):
+    """
+    Posts the credits collected by every post_query_rows_processed batch. This is kept in
+    its own task, apart from the Snowflake query and the rows processed metrics, so that
+    retrying a failure there never re-sends credits the API already accepted.
+    """
+    query_costs = [row for rows in query_costs for row in rows]
+    if not query_costs:
+        print("No costs to post")
+        return
+
+    base_by_query_id = ti.xcom_pull(key="query_id_map", task_ids="get_query_ids")
+
+    # Credits go out in a single request rather than through post_metrics_batch, so a
+    # failed page can't leave some credits posted and others not. This is not
+    # exactly-once: if the request fails after the API accepted it (e.g. a read timeout
+    # on the response), the task retry posts the credits again. The longer read timeout
+    # makes that less likely for large bodies.
+    token = var["value"].AUTH_TOKEN
+    post_metrics(
+        token,
+        "COST",
+        "SNOWFLAKE_CREDITS",
+        _cost_metrics(query_costs, base_by_query_id),
+        timeout=CREDITS_REQUEST_TIMEOUT,
+    )
+
+
+@task
+def post_query_rows_processed(query_ids: list[str], ti, var) -> list:
+    """
+    Queries Snowflake for the credits and rows processed of a batch of query IDs. Rows
+    processed are posted to the Astronomer API page by page, so that result is never held
+    in memory or pushed through XCom. Only the small (query_id, end_time, credit) rows are
+    collected and returned, for post_cost_attribution to post in its own retry unit.
+    """
+    base_by_query_id = ti.xcom_pull(key="query_id_map", task_ids="get_query_ids")
     token = var["value"].AUTH_TOKEN
 
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_ROWS_PRODUCED", produced)
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_ROWS_INSERTED", inserted)
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_ROWS_UPDATED", updated)
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_ROWS_DELETED", deleted)
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_ROWS_UNLOADED", unloaded)
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_TOTAL_ELAPSED_TIME", elapsed)
-    post_metrics(token, "CUSTOM", "SNOWFLAKE_BYTES_SCANNED", scanned)
+    query_costs = []
+    total = 0
+    with _snowflake_hook().get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            QUERY_ATTRIBUTION_SQL, (query_ids,), timeout=SNOWFLAKE_QUERY_TIMEOUT
+        )
+        while rows := cur.fetchmany(SNOWFLAKE_FETCH_SIZE):
+            total += len(rows)
+            cost_rows, processed_rows = _split_attribution_rows(rows)
+            query_costs.extend(cost_rows)
+            post_metrics_batch(
+                token, _rows_processed_metrics(processed_rows, base_by_query_id)
+            )
+
+    if not total:
+        print("No rows processed to post")
+
+    return query_costs
 
 
 @dag(
     start_date=datetime.datetime(2024, 10, 1),
     schedule="@hourly",
     catchup=False,
-    render_template_as_native_obj=True,
     default_args={
         "retries": 3,
         "retry_delay": datetime.timedelta(minutes=1),
@@ -216,45 +462,13 @@ def cost_attribution():
     """
     check_env_vars()
     get_queries = get_query_ids()
-    check = check_for_query_ids(get_queries["query_ids"])
-
-    cost_attribution = SQLExecuteQueryOperator(
-        task_id="cost_attribution",
-        conn_id="snowflake",
-        sql="""
-            select
-                query_id,
-                end_time,
-                credits_attributed_compute
-            from snowflake.account_usage.query_attribution_history
-            where query_id in (%s)
-        """,
-        parameters=[get_queries["query_ids"]],
-    )
+    check = check_for_query_ids(get_queries["query_count"])
 
-    rows_processed_attribution = SQLExecuteQueryOperator(
-        task_id="rows_processed_attribution",
-        conn_id="snowflake",
-        sql="""
-            select
-                query_id,
-                rows_produced,
-                rows_inserted,
-                rows_updated,
-                rows_deleted,
-                rows_unloaded,
-                total_elapsed_time,
-                bytes_scanned,
-                end_time
-            from snowflake.account_usage.query_history
-            where query_id in ( %s )
-        """,
-        parameters=[get_queries["query_ids"]],
-    )
+    query_id_chunks = chunk_query_ids(get_queries["query_ids"])
 
-    check >> [cost_attribution, rows_processed_attribution]
-    post_cost_attribution(query_costs=cost_attribution.output)
-    post_query_rows_processed(rows_processed=rows_processed_attribution.output)
+    check >> query_id_chunks
+    query_costs = post_query_rows_processed.expand(query_ids=query_id_chunks)
+    post_cost_attribution(query_costs=query_costs)
 
 
 cost_attribution()
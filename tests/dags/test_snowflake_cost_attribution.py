@@ -0,0 +1,348 @@
+"""Unit tests for the helpers in the cost attribution DAG. These don't need a running Airflow."""
+
+import datetime
+import decimal
+import json
+import os
+import sys
+import types
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "dags"))
+
+import snowflake_cost_attribution as dag_module  # noqa: E402
+
+BASE_BY_QUERY_ID = {
+    "q1": {
+        "assetId": "asset-1",
+        "deploymentId": "deployment-1",
+        "workspaceId": "workspace-1",
+        "runId": "run-1",
+        "dagId": "dag-1",
+        "taskId": "task-1",
+        "namespace": "namespace-1",
+    },
+    "q2": {
+        "assetId": "asset-2",
+        "deploymentId": "deployment-2",
+        "workspaceId": None,
+        "runId": "run-2",
+        "dagId": "dag-2",
+        "taskId": "task-2",
+        "namespace": "namespace-2",
+    },
+}
+
+END_TIME = datetime.datetime(2024, 10, 1, 12, 30, 45, 123456)
+
+
+def test_cost_metrics_posts_every_attributed_row():
+    rows = [("q1", END_TIME, 1.5), ("q2", END_TIME, None)]
+
+    costs = dag_module._cost_metrics(rows, BASE_BY_QUERY_ID)
+
+    assert costs == [
+        {
+            **BASE_BY_QUERY_ID["q1"],
+            "timestamp": "2024-10-01T12:30:45.123456Z",
+            "value": 1.5,
+        },
+        {
+            **BASE_BY_QUERY_ID["q2"],
+            "timestamp": "2024-10-01T12:30:45.123456Z",
+            "value": None,
+        },
+    ]
+
+
+def test_cost_metrics_does_not_mutate_base():
+    dag_module._cost_metrics([("q1", END_TIME, 1.5)], BASE_BY_QUERY_ID)
+
+    assert "value" not in BASE_BY_QUERY_ID["q1"]
+    assert "timestamp" not in BASE_BY_QUERY_ID["q1"]
+
+
+def test_split_attribution_rows():
+    rows = [
+        ("q1", END_TIME, True, 1.5, 1, 2, 3, 4, 5, 6, 7),
+        ("q2", END_TIME, False, None, 8, 9, 10, 11, 12, 13, 14),
+    ]
+
+    cost_rows, processed_rows = dag_module._split_attribution_rows(rows)
+
+    assert cost_rows == [("q1", END_TIME, 1.5)]
+    assert processed_rows == [
+        ("q1", END_TIME, 1, 2, 3, 4, 5, 6, 7),
+        ("q2", END_TIME, 8, 9, 10, 11, 12, 13, 14),
+    ]
+
+
+def test_rows_processed_metrics_column_order():
+    rows = [("q1", END_TIME, 1, 2, 3, 4, 5, 6, 7)]
+
+    groups = dag_module._rows_processed_metrics(rows, BASE_BY_QUERY_ID)
+
+    assert [(group["type"], group["metrics"][0]["value"]) for group in groups] == [
+        ("SNOWFLAKE_ROWS_PRODUCED", 1),
+        ("SNOWFLAKE_ROWS_INSERTED", 2),
+        ("SNOWFLAKE_ROWS_UPDATED", 3),
+        ("SNOWFLAKE_ROWS_DELETED", 4),
+        ("SNOWFLAKE_ROWS_UNLOADED", 5),
+        ("SNOWFLAKE_TOTAL_ELAPSED_TIME", 6),
+        ("SNOWFLAKE_BYTES_SCANNED", 7),
+    ]
+    for group in groups:
+        assert group["category"] == "CUSTOM"
+        assert group["metrics"][0] == {
+            **BASE_BY_QUERY_ID["q1"],
+            "timestamp": "2024-10-01T12:30:45.123456Z",
+            "value": group["metrics"][0]["value"],
+        }
+
+
+def test_rows_processed_metrics_defaults_nulls_to_zero():
+    rows = [("q2", END_TIME, None, None, None, None, None, None, None)]
+
+    groups = dag_module._rows_processed_metrics(rows, BASE_BY_QUERY_ID)
+
+    assert len(groups) == 7
+    assert all(group["metrics"][0]["value"] == 0 for group in groups)
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (datetime.datetime(2024, 10, 1, 12, 30, 45), "2024-10-01T12:30:45.000000Z"),
+        (END_TIME, "2024-10-01T12:30:45.123456Z"),
+        (
+            END_TIME.replace(tzinfo=datetime.timezone.utc),
+            "2024-10-01T12:30:45.123456Z",
+        ),
+        (
+            END_TIME.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=-7))),
+            "2024-10-01T19:30:45.123456Z",
+        ),
+    ],
+    ids=["naive-no-microseconds", "naive", "utc", "offset"],
+)
+def test_rfc3339(value, expected):
+    assert dag_module._rfc3339(value) == expected
+
+
+@pytest.mark.parametrize("use_orjson", [True, False], ids=["orjson", "stdlib"])
+def test_dumps_handles_decimal(monkeypatch, use_orjson):
+    if use_orjson and dag_module.orjson is None:
+        pytest.skip("orjson is not installed")
+    if not use_orjson:
+        monkeypatch.setattr(dag_module, "orjson", None)
+
+    body = dag_module._dumps({"metrics": [{"value": decimal.Decimal("1.25")}]})
+
+    assert isinstance(body, bytes)
+    assert json.loads(body) == {"metrics": [{"value": 1.25}]}
+
+
+def test_dumps_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        dag_module._dumps({"value": object()})
+
+
+@pytest.fixture
+def posted(monkeypatch):
+    """Replaces post_metrics with a recorder of (category, type, page size) calls."""
+    calls = []
+
+    def post_metrics(token, category, type, data):
+        calls.append((category, type, len(data)))
+
+    monkeypatch.setattr(dag_module, "post_metrics", post_metrics)
+    return calls
+
+
+def test_post_metrics_batch_splits_pages(posted):
+    size = dag_module.METRICS_CHUNK_SIZE
+    groups = [
+        {"category": "CUSTOM", "type": "A", "metrics": [{}] * (2 * size + 1)},
+        {"category": "CUSTOM", "type": "B", "metrics": [{}] * size},
+        {"category": "CUSTOM", "type": "C", "metrics": []},
+    ]
+
+    dag_module.post_metrics_batch("token", groups)
+
+    assert sorted(posted) == [
+        ("CUSTOM", "A", 1),
+        ("CUSTOM", "A", size),
+        ("CUSTOM", "A", size),
+        ("CUSTOM", "B", size),
+    ]
+
+
+def test_post_metrics_batch_without_metrics_posts_nothing(posted):
+    dag_module.post_metrics_batch("token", [])
+    dag_module.post_metrics_batch(
+        "token", [{"category": "CUSTOM", "type": "A", "metrics": []}]
+    )
+
+    assert posted == []
+
+
+def test_post_metrics_batch_aggregates_errors(monkeypatch):
+    calls = []
+
+    def post_metrics(token, category, type, data):
+        calls.append(type)
+        if type != "OK":
+            raise Exception(f"Failed to post {type}")
+
+    monkeypatch.setattr(dag_module, "post_metrics", post_metrics)
+    groups = [
+        {"category": "CUSTOM", "type": type, "metrics": [{}]}
+        for type in ("OK", "BAD_1", "BAD_2")
+    ]
+
+    with pytest.raises(Exception, match="Failed to post 2 of 3 metric requests") as e:
+        dag_module.post_metrics_batch("token", groups)
+
+    # Every page is still attempted before the failures are raised together
+    assert sorted(calls) == ["BAD_1", "BAD_2", "OK"]
+    assert "BAD_1" in str(e.value) and "BAD_2" in str(e.value)
+
+
+@pytest.mark.parametrize(
+    "count,expected_sizes",
+    [(0, []), (1, [1]), (3, [3]), (4, [3, 1]), (6, [3, 3]), (7, [3, 3, 1])],
+)
+def test_chunk_query_ids_boundaries(monkeypatch, count, expected_sizes):
+    monkeypatch.setattr(dag_module, "SNOWFLAKE_IN_LIST_LIMIT", 3)
+    query_ids = [f"q{i}" for i in range(count)]
+
+    chunks = dag_module.chunk_query_ids.function(query_ids)
+
+    assert [len(chunk) for chunk in chunks] == expected_sizes
+    assert [query_id for chunk in chunks for query_id in chunk] == query_ids
+
+
+def test_session_parameters_defaults_without_connection_parameters():
+    assert dag_module._session_parameters(None) == {
+        "USE_CACHED_RESULT": True,
+        "QUERY_TAG": "astro-observe-cost",
+    }
+
+
+def test_session_parameters_keep_connection_values():
+    parameters = dag_module._session_parameters(
+        {"QUERY_TAG": "team-etl", "TIMEZONE": "America/Los_Angeles"}
+    )
+
+    assert parameters == {
+        "USE_CACHED_RESULT": True,
+        "QUERY_TAG": "team-etl",
+        "TIMEZONE": "America/Los_Angeles",
+    }
+
+
+@pytest.fixture
+def session_post(monkeypatch):
+    """Replaces the shared session's post with a recorder answering with a given status."""
+    calls = []
+    status = {"code": 200}
+
+    def post(url, **kwargs):
+        calls.append({"url": url, **kwargs})
+        resp = requests.Response()
+        resp.status_code = status["code"]
+        resp.reason = "Internal Server Error" if status["code"] >= 500 else "OK"
+        resp.url = url
+        resp._content = b"boom" if status["code"] >= 500 else b""
+        return resp
+
+    monkeypatch.setenv("ASTRO_ORGANIZATION_ID", "org-1")
+    monkeypatch.setattr(dag_module._SESSION, "post", post)
+    return calls, status
+
+
+@pytest.mark.parametrize("status_code", [200, 201, 204])
+def test_post_metrics_sends_json_bytes(session_post, status_code):
+    calls, status = session_post
+    status["code"] = status_code
+    data = [{"value": decimal.Decimal("1.5")}]
+
+    dag_module.post_metrics("token", "COST", "SNOWFLAKE_CREDITS", data)
+
+    [call] = calls
+    assert call["url"].endswith("/organizations/org-1/observability/metrics")
+    assert isinstance(call["data"], bytes)
+    assert json.loads(call["data"]) == {
+        "category": "COST",
+        "type": "SNOWFLAKE_CREDITS",
+        "metrics": [{"value": 1.5}],
+    }
+    assert call["headers"] == {
+        "Authorization": "Bearer token",
+        "Content-Type": "application/json",
+    }
+    assert call["timeout"] == dag_module.REQUEST_TIMEOUT
+
+
+def test_post_metrics_passes_custom_timeout(session_post):
+    calls, _ = session_post
+
+    dag_module.post_metrics(
+        "token",
+        "COST",
+        "SNOWFLAKE_CREDITS",
+        [],
+        timeout=dag_module.CREDITS_REQUEST_TIMEOUT,
+    )
+
+    assert calls[0]["timeout"] == dag_module.CREDITS_REQUEST_TIMEOUT
+
+
+def test_post_metrics_wraps_http_errors(session_post):
+    _, status = session_post
+    status["code"] = 500
+
+    with pytest.raises(
+        Exception,
+        match="Failed to post SNOWFLAKE_CREDITS: 500:Internal Server Error boom",
+    ) as e:
+        dag_module.post_metrics("token", "COST", "SNOWFLAKE_CREDITS", [])
+
+    assert isinstance(e.value.__cause__, requests.exceptions.HTTPError)
+
+
+def test_snowflake_hook_merges_connection_session_parameters(monkeypatch):
+    requested = []
+
+    def get_connection(cls, conn_id):
+        requested.append(conn_id)
+        return types.SimpleNamespace(
+            extra_dejson={"session_parameters": {"TIMEZONE": "UTC"}}
+        )
+
+    monkeypatch.setattr(
+        dag_module.SnowflakeHook, "get_connection", classmethod(get_connection)
+    )
+
+    hook = dag_module._snowflake_hook()
+
+    assert requested == [dag_module.SNOWFLAKE_CONN_ID]
+    assert hook.session_parameters == {
+        "USE_CACHED_RESULT": True,
+        "QUERY_TAG": "astro-observe-cost",
+        "TIMEZONE": "UTC",
+    }
+
+
+def test_snowflake_hook_without_connection_session_parameters(monkeypatch):
+    monkeypatch.setattr(
+        dag_module.SnowflakeHook,
+        "get_connection",
+        classmethod(lambda cls, conn_id: types.SimpleNamespace(extra_dejson={})),
+    )
+
+    hook = dag_module._snowflake_hook()
+
+    assert hook.session_parameters == dag_module.SNOWFLAKE_SESSION_PARAMETERS